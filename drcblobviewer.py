@@ -3,47 +3,47 @@
 drcblobviewer - View and edit DRC resource blobs
 Created in 2024 by GaryOderNichts
 <https://github.com/GaryOderNichts/drcblobviewer>
+
+Pillow-SIMD can be installed in place of Pillow for faster thumbnail generation.
 """
 import tkinter as tk
 import tkinter.filedialog
-import construct
 from PIL import Image, ImageTk
 import sys
+import struct
 from enum import IntEnum
 from pydub import AudioSegment
 from pydub.playback import play
-import io
+try:
+    import simpleaudio
+except ImportError:
+    simpleaudio = None
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import threading
+from types import SimpleNamespace
 
 # Structs
-BitmapResourceDescriptor = construct.Struct(
-    "unknown" / construct.Int32ul, # maybe format / bpp?
-    "width" / construct.Int32ul,
-    "height" / construct.Int32ul
-)
-
-SoundResourceDescriptor = construct.Struct(
-    "unknown0" / construct.Int16ul, # maybe format?, seems to always be 0
-    "unknown1" / construct.Int16ul, # always 0x10 (bits?)
-    "unknown2" / construct.Int32ul, # always 1, channels?
-    "frequency" / construct.Int32ul
+ResourceDescriptorStruct = struct.Struct(
+    "<H"  # type
+    "H"   # id
+    "I"   # offset
+    "I"   # size
+    "12s" # BitmapResourceDescriptorStruct or SoundResourceDescriptorStruct depending on type
 )
 
-ResourceDescriptor = construct.Struct(
-    "type" / construct.Int16ul,
-    "id" / construct.Int16ul,
-    "offset" / construct.Int32ul,
-    "size" / construct.Int32ul,
-    # todo make this dependant on type
-    "_" / construct.Union(0,
-        "bitmap" / BitmapResourceDescriptor,
-        "sound" / SoundResourceDescriptor
-    )
+BitmapResourceDescriptorStruct = struct.Struct(
+    "<I" # unknown, maybe format / bpp?
+    "I"  # width
+    "I"  # height
 )
 
-ResourceBlob = construct.Struct(
-    "descriptorCount" / construct.Int32ul,
-    "descriptors" / construct.Array(construct.this.descriptorCount, ResourceDescriptor)
+SoundResourceDescriptorStruct = struct.Struct(
+    "<H" # unknown0, maybe format?, seems to always be 0
+    "H"  # unknown1, always 0x10 (bits?)
+    "I"  # unknown2, always 1, channels?
+    "I"  # frequency
 )
 
 # Classes
@@ -53,6 +53,8 @@ class ResourceType(IntEnum):
     UNKNOWN = 0x2
 
 class Resource:
+    __slots__ = ('type',)
+
     type: ResourceType
 
     def __init__(self, type):
@@ -61,28 +63,66 @@ class Resource:
     def get_type(self):
         return self.type
 
+# White background template for bitmap previews, copied instead of created for every preview
+@lru_cache(maxsize=4)
+def blank_preview(size):
+    return Image.new('RGB', size, (255, 255, 255))
+
 # Represents a bitmap resource
 class BitmapResource(Resource):
-    descriptor = None
-    bitmap_descriptor = None
-    image: Image
+    __slots__ = ('descriptor', 'bitmap_descriptor', 'data', '_image', '_bgra_palette', '_lock')
 
     def __init__(self, descriptor, data):
         super().__init__(descriptor.type)
 
         self.descriptor = descriptor
-        self.bitmap_descriptor = descriptor._.bitmap
-
-        self.image = Image.frombytes("P", [self.bitmap_descriptor.width, self.bitmap_descriptor.height], data[256*4:])
-        self.image.putpalette(data[:256*4], "BGRA")
+        self.bitmap_descriptor = descriptor.bitmap
+
+        # the image is decoded on first access
+        self.data = data
+        self._image = None
+        # packed palette, kept until the image is replaced
+        self._bgra_palette = None
+        # previews are generated in worker threads, so decoding and replacing is guarded
+        self._lock = threading.Lock()
+
+    @property
+    def image(self):
+        image = self._image
+        if image is None:
+            with self._lock:
+                if self._image is None:
+                    # reference the pixel data directly instead of copying it
+                    image = Image.frombuffer("P", (self.bitmap_descriptor.width, self.bitmap_descriptor.height), self.data[256*4:], "raw", "P", 0, 1)
+                    palette = bytes(self.data[:256*4])
+                    image.putpalette(palette, "BGRA")
+
+                    # only publish the image once it's complete
+                    self._bgra_palette = palette
+                    self._image = image
+
+                image = self._image
+
+        return image
+
+    @image.setter
+    def image(self, image):
+        with self._lock:
+            self._bgra_palette = None
+            self._image = image
+            self.data = None
 
     def get_preview_image(self, size):
         # create a preview thumbnail
         preview = self.image.copy()
         preview.thumbnail(size)
-        
+
+        # no need for a background if the thumbnail fills the whole preview
+        if preview.size == size:
+            return preview.convert('RGB')
+
         # create a white background
-        background = Image.new('RGB', size, (255, 255, 255))
+        background = blank_preview(size).copy()
 
         # paste thumbnail onto background
         offset = ((background.width - preview.width) // 2, (background.height - preview.height) // 2)
@@ -91,12 +131,20 @@ class BitmapResource(Resource):
         return background
 
     def pack_data(self):
-        buffer = b""
-        pallette = self.image.getpalette("BGRA")
-        buffer += bytes(pallette)
-        data = self.image.getdata()
-        buffer += bytes(data)
-        return buffer
+        # the raw data is only dropped when the image is replaced, so it's still up to date
+        if self.data is not None:
+            return self.data
+
+        if self._bgra_palette is None:
+            self._bgra_palette = bytes(self.image.getpalette("BGRA"))
+
+        return self._bgra_palette + self.image.tobytes()
+
+    def pack_descriptor(self):
+        d = self.descriptor
+        bd = self.bitmap_descriptor
+        payload = BitmapResourceDescriptorStruct.pack(bd.unknown, bd.width, bd.height)
+        return ResourceDescriptorStruct.pack(d.type, d.id, d.offset, d.size, payload)
 
     def __str__(self):
         return f"""BitmapResource:
@@ -106,23 +154,54 @@ class BitmapResource(Resource):
 
 # Represents a sound resource
 class SoundResource(Resource):
-    descriptor = None
-    sound_descriptor = None
-    segment: AudioSegment = None
+    __slots__ = ('descriptor', 'sound_descriptor', 'data', '_segment')
+
+    # resized preview images shared by all sound resources, keyed by size
+    _preview_cache = {}
 
     def __init__(self, descriptor, data):
         super().__init__(descriptor.type)
 
         self.descriptor = descriptor
-        self.sound_descriptor = self.descriptor._.sound
-        self.segment = AudioSegment.from_file(io.BytesIO(data), format="raw", frame_rate=self.sound_descriptor.frequency, channels=1, sample_width=2)
+        self.sound_descriptor = self.descriptor.sound
+        # the segment is only decoded once it's needed
+        self.data = data
+        self._segment = None
+
+    @property
+    def segment(self):
+        if self._segment is None:
+            self._segment = AudioSegment(data=bytes(self.data), sample_width=2, frame_rate=self.sound_descriptor.frequency, channels=1)
+            self.data = None
+
+        return self._segment
+
+    @segment.setter
+    def segment(self, segment):
+        self._segment = segment
+        self.data = None
 
     def get_preview_image(self, size):
-        return Image.open(os.path.join(sys.path[0], "assets/sound.png")).resize(size)
+        preview = SoundResource._preview_cache.get(size)
+        if preview is None:
+            preview = Image.open(os.path.join(sys.path[0], "assets/sound.png")).resize(size)
+            SoundResource._preview_cache[size] = preview
+
+        return preview
 
     def pack_data(self):
+        # no need to decode the segment if it was never touched
+        if self._segment is None:
+            return self.data
+
         return self.segment.raw_data
 
+    def pack_descriptor(self):
+        d = self.descriptor
+        sd = self.sound_descriptor
+        payload = SoundResourceDescriptorStruct.pack(sd.unknown0, sd.unknown1, sd.unknown2, sd.frequency)
+        return ResourceDescriptorStruct.pack(d.type, d.id, d.offset, d.size, payload)
+
     def __str__(self):
         return f"""SoundResource:
                 ID: 0x{self.descriptor.id:04x}
@@ -135,8 +214,35 @@ class SoundResource(Resource):
 resources = []
 sound_menu = None
 bitmap_menu = None
+# resource index and label the popup menus were opened for
+popup_idx = None
+popup_img = None
+# currently playing sound, if played with simpleaudio
+playback = None
+# thumbnails still being generated, resource index -> (label, future)
+pending_thumbnails = {}
 
 # Functions
+def parse_descriptors(file):
+    count = int.from_bytes(file.read(4), "little")
+    table = file.read(count * ResourceDescriptorStruct.size)
+
+    descriptors = []
+    for res_type, res_id, offset, size, payload in ResourceDescriptorStruct.iter_unpack(table):
+        d = SimpleNamespace(type=res_type, id=res_id, offset=offset, size=size)
+
+        # only unpack the payload matching the resource type
+        if res_type == ResourceType.BITMAP:
+            unknown, width, height = BitmapResourceDescriptorStruct.unpack(payload)
+            d.bitmap = SimpleNamespace(unknown=unknown, width=width, height=height)
+        elif res_type == ResourceType.SOUND:
+            unknown0, unknown1, unknown2, frequency = SoundResourceDescriptorStruct.unpack(payload)
+            d.sound = SimpleNamespace(unknown0=unknown0, unknown1=unknown1, unknown2=unknown2, frequency=frequency)
+
+        descriptors.append(d)
+
+    return descriptors
+
 def save_file():
     tkinter.messagebox.showwarning(title = "Warning", message = "Edited resources are currently broken.\nOnly flash this to your gamepad if you know what you're doing.")
 
@@ -144,22 +250,35 @@ def save_file():
     if f is None:
         return
 
-    descriptors = b""
-    data = b""
+    descriptors = []
+    data = []
+    offset = 0
     for r in resources:
         buffer = r.pack_data()
-        r.descriptor.offset = len(data)
+        r.descriptor.offset = offset
         r.descriptor.size = len(buffer)
-        descriptors += ResourceDescriptor.build(r.descriptor)
-        data += buffer
+        descriptors.append(r.pack_descriptor())
+        data.append(buffer)
+        offset += len(buffer)
 
     f.write(len(resources).to_bytes(4, "little"))
-    f.write(descriptors)
-    f.write(data)
+    f.write(b"".join(descriptors))
+    # write resource data directly instead of joining it first
+    for buffer in data:
+        f.write(buffer)
     f.close()
 
 def play_sound(resource):
-    play(resource.segment)
+    segment = resource.segment
+    if simpleaudio is None:
+        play(segment)
+        return
+
+    # play asynchronously and stop whatever is still playing
+    global playback
+    if playback is not None:
+        playback.stop()
+    playback = simpleaudio.play_buffer(segment.raw_data, segment.channels, segment.sample_width, segment.frame_rate)
 
 def properties_sound(resource):
     properties = tk.Toplevel()
@@ -181,15 +300,14 @@ def replace_sound(idx):
     segment = AudioSegment.from_file(f, format="wav")
     segment = segment.set_channels(1)
     segment = segment.set_sample_width(2)
-    segment = segment.set_frame_rate(resources[idx].sound_descriptor.frequency)
-    resources[idx].segment = segment
+    res = resources[idx]
+    segment = segment.set_frame_rate(res.sound_descriptor.frequency)
+    res.segment = segment
 
-def do_sound_popup(event, resource, idx):
+def do_sound_popup(event, idx):
+    global popup_idx
+    popup_idx = idx
     try:
-        sound_menu.entryconfig("Play", command=lambda: play_sound(resource))
-        sound_menu.entryconfig("Properties", command=lambda: properties_sound(resource))
-        sound_menu.entryconfig("Save as", command=lambda: save_sound(resource))
-        sound_menu.entryconfig("Replace", command=lambda: replace_sound(idx))
         sound_menu.tk_popup(event.x_root, event.y_root)
     finally:
         sound_menu.grab_release()
@@ -200,11 +318,9 @@ def view_bitmap(resource):
 def view_palette_bitmap(resource):
     palette = tk.Toplevel()
     
-    pal = resource.image.getpalette("RGBA")
-    string = ""
-    for i in range(256):
-        offset = i * 4
-        string += f"0x{i:02x}: #{pal[offset]:02x}{pal[offset + 1]:02x}{pal[offset + 2]:02x}{pal[offset + 3]:02x}\n"
+    # hex encode the whole palette at once and split it into RGBA entries
+    pal = bytes(resource.image.getpalette("RGBA")).hex()
+    string = "".join(f"0x{i:02x}: #{pal[i * 8:i * 8 + 8]}\n" for i in range(len(pal) // 8))
 
     text = tk.Text(palette)
     text.insert(tk.END, string)
@@ -223,6 +339,29 @@ def save_bitmap(resource):
         return
     resource.image.save(f, "PNG")
 
+def quantize_to_palette(image, palette_image):
+    palette = palette_image.getpalette("RGBA")
+    entries = [palette[i:i + 4] for i in range(0, len(palette), 4)]
+
+    # opaque pixels may only map to opaque entries, transparent ones to a transparent entry
+    opaque = [i for i, e in enumerate(entries) if e[3] == 255] or [i for i, e in enumerate(entries) if e[3] > 0] or list(range(len(entries)))
+    transparent = next((i for i, e in enumerate(entries) if e[3] == 0), None)
+
+    # quantize against the opaque entries only, then map back to the original indices
+    lookup = bytes(opaque[i % len(opaque)] for i in range(256))
+    opaque_palette = Image.new("P", (1, 1))
+    opaque_palette.putpalette([c for i in lookup for c in entries[i][:3]])
+    quantized = image.convert("RGB").quantize(palette=opaque_palette, dither=Image.Dither.FLOYDSTEINBERG)
+
+    result = Image.frombytes("P", image.size, quantized.tobytes().translate(lookup))
+    result.putpalette(bytes(palette), "RGBA")
+
+    if transparent is not None:
+        mask = image.getchannel("A").point(lambda a: 255 if a < 128 else 0)
+        result.paste(transparent, mask=mask)
+
+    return result
+
 def replace_bitmap(idx, img):
     f = tkinter.filedialog.askopenfile("rb", defaultextension=".png")
     if f is None:
@@ -230,26 +369,48 @@ def replace_bitmap(idx, img):
 
     # Convert the image to a palletized version with the original info
     image = Image.open(f)
-    image = image.resize((resources[idx].bitmap_descriptor.width, resources[idx].bitmap_descriptor.height))
+    res = resources[idx]
+    bd = res.bitmap_descriptor
+    image = image.resize((bd.width, bd.height))
+    # map onto the original palette instead of generating a new one
     image = image.convert("RGBA")
-    resources[idx].image = image.quantize()
+    res.image = quantize_to_palette(image, res.image)
 
-    # Update thumbnail
-    tkimage = ImageTk.PhotoImage(resources[idx].get_preview_image((150, 150)))
+    # Update thumbnail, and make sure a late preview of the old image doesn't replace it
+    pending_thumbnails.pop(idx, None)
+    tkimage = ImageTk.PhotoImage(res.get_preview_image((150, 150)))
     img.configure(image=tkimage)
     img.image = tkimage
 
-def do_bitmap_popup(event, resource, idx, img):
+def do_bitmap_popup(event, idx, img):
+    global popup_idx, popup_img
+    popup_idx = idx
+    popup_img = img
     try:
-        bitmap_menu.entryconfig("View", command=lambda: view_bitmap(resource))
-        bitmap_menu.entryconfig("View Palette", command=lambda: view_palette_bitmap(resource))
-        bitmap_menu.entryconfig("Properties", command=lambda: properties_bitmap(resource))
-        bitmap_menu.entryconfig("Save as", command=lambda: save_bitmap(resource))
-        bitmap_menu.entryconfig("Replace", command=lambda: replace_bitmap(idx, img))
         bitmap_menu.tk_popup(event.x_root, event.y_root)
     finally:
         bitmap_menu.grab_release()
 
+def install_thumbnails(window):
+    # PhotoImages have to be created on the Tk thread, so poll for finished previews
+    for idx, (label, future) in list(pending_thumbnails.items()):
+        if not future.done():
+            continue
+
+        del pending_thumbnails[idx]
+        try:
+            preview = future.result()
+        except Exception as e:
+            print(f"Failed to create preview for resource {idx}: {e}")
+            continue
+
+        tkimage = ImageTk.PhotoImage(preview)
+        label.configure(image=tkimage)
+        label.image = tkimage
+
+    if pending_thumbnails:
+        window.after(10, install_thumbnails, window)
+
 def print_usage():
     print("Usage:")
     print(f"    {sys.argv[0]}: <filename> [offset]")
@@ -266,14 +427,16 @@ def main():
             fileoffset = int(sys.argv[2], 0)
             file.seek(fileoffset)
 
-        img_resource = ResourceBlob.parse_stream(file)
+        descriptors = parse_descriptors(file)
+
+        # The resource data directly follows the descriptor table, read all of it at once
+        data = memoryview(file.read(max((d.offset + d.size for d in descriptors), default=0)))
 
-        for d in img_resource.descriptors:
-            file.seek(fileoffset + 4 + img_resource.descriptorCount * 0x18 + d.offset)
+        for d in descriptors:
             if d.type == ResourceType.BITMAP:
-                resources.append(BitmapResource(d, file.read(d.size)))
+                resources.append(BitmapResource(d, data[d.offset:d.offset + d.size]))
             elif d.type == ResourceType.SOUND:
-                resources.append(SoundResource(d, file.read(d.size)))
+                resources.append(SoundResource(d, data[d.offset:d.offset + d.size]))
             else:
                 print(f"Unsupported resource type {d.type} in file")
                 sys.exit()
@@ -300,32 +463,36 @@ def main():
 
     global sound_menu
     sound_menu = tk.Menu(window)
-    sound_menu.add_command(label="Play")
-    sound_menu.add_command(label="Properties")
-    sound_menu.add_command(label="Save as")
-    sound_menu.add_command(label="Replace")
+    sound_menu.add_command(label="Play", command=lambda: play_sound(resources[popup_idx]))
+    sound_menu.add_command(label="Properties", command=lambda: properties_sound(resources[popup_idx]))
+    sound_menu.add_command(label="Save as", command=lambda: save_sound(resources[popup_idx]))
+    sound_menu.add_command(label="Replace", command=lambda: replace_sound(popup_idx))
 
     global bitmap_menu
     bitmap_menu = tk.Menu(window)
-    bitmap_menu.add_command(label="View")
-    bitmap_menu.add_command(label="View Palette")
-    bitmap_menu.add_command(label="Properties")
-    bitmap_menu.add_command(label="Save as")
-    bitmap_menu.add_command(label="Replace")
-
-    # Create grid for resources
+    bitmap_menu.add_command(label="View", command=lambda: view_bitmap(resources[popup_idx]))
+    bitmap_menu.add_command(label="View Palette", command=lambda: view_palette_bitmap(resources[popup_idx]))
+    bitmap_menu.add_command(label="Properties", command=lambda: properties_bitmap(resources[popup_idx]))
+    bitmap_menu.add_command(label="Save as", command=lambda: save_bitmap(resources[popup_idx]))
+    bitmap_menu.add_command(label="Replace", command=lambda: replace_bitmap(popup_idx, popup_img))
+
+    # Create grid for resources, previews are generated in the background
+    placeholder = ImageTk.PhotoImage(Image.new('RGB', (150, 150), (200, 200, 200)))
+    executor = ThreadPoolExecutor()
     for i, res in enumerate(resources):
         r, c = divmod(i, 5)
-        im = res.get_preview_image((150, 150))
-        tkimage = ImageTk.PhotoImage(im)
-        myvar = tk.Label(window, image=tkimage)
-        myvar.image = tkimage
+        myvar = tk.Label(window, image=placeholder)
+        myvar.image = placeholder
         myvar.grid(row=r, column=c)
+        pending_thumbnails[i] = (myvar, executor.submit(res.get_preview_image, (150, 150)))
 
         if res.get_type() == ResourceType.SOUND:
-            myvar.bind("<Button-3>", lambda ev, r=res, idx=i: do_sound_popup(ev, r, idx))
+            myvar.bind("<Button-3>", lambda ev, idx=i: do_sound_popup(ev, idx))
         elif res.get_type() == ResourceType.BITMAP:
-            myvar.bind("<Button-3>", lambda ev, r=res, idx=i, img=myvar: do_bitmap_popup(ev, r, idx, img))
+            myvar.bind("<Button-3>", lambda ev, idx=i, img=myvar: do_bitmap_popup(ev, idx, img))
+
+    executor.shutdown(wait=False)
+    install_thumbnails(window)
 
     window.mainloop()
     return 0